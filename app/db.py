@@ -1,5 +1,8 @@
-import hashlib
+import sys
 
+from argon2 import PasswordHasher
+from sqlalchemy import delete, exists, func, inspect, text
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlmodel import SQLModel, create_engine, Session, select
 
 from .config import DATABASE_URL
@@ -11,21 +14,74 @@ _url = DATABASE_URL
 if _url.startswith("postgres://"):
     _url = "postgresql://" + _url[len("postgres://") :]
 
-db_engine = create_engine(_url, echo=False)
+# Handlers run on FastAPI's threadpool and each holds a connection for the whole
+# request, so give Postgres a pool sized for that concurrency. Pre-ping and
+# recycle drop connections the host has closed behind our back.
+if _url.startswith("sqlite"):
+    db_engine = create_engine(_url, echo=False)
+else:
+    db_engine = create_engine(
+        _url,
+        echo=False,
+        pool_size=20,
+        max_overflow=40,
+        pool_pre_ping=True,
+        pool_recycle=3600,
+    )
+
+# Argon2id with OWASP-recommended parameters (64 MiB memory, 3 passes, 2 lanes)
+password_hasher = PasswordHasher(memory_cost=65536, time_cost=3, parallelism=2)
 
 
 def hash_password(raw: str) -> str:
-    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+    return password_hasher.hash(raw)
+
+
+def upsert_insert(model):
+    """INSERT construct for the active dialect, exposing on_conflict_do_* helpers."""
+    if db_engine.dialect.name == "postgresql":
+        return postgresql.insert(model)
+    return sqlite.insert(model)
+
+
+def _drop_duplicates(idx) -> None:
+    """Delete rows that would violate a unique index. Data written before the
+    index existed was never kept unique. Keeps each user's latest check-in
+    (MAX(id)) and otherwise the oldest row (MIN(id))."""
+    table = idx.table
+    keep = func.max if table is CheckIn.__table__ else func.min
+    keep_ids = select(keep(table.c.id)).group_by(*idx.columns)
+    with db_engine.begin() as conn:
+        conn.execute(delete(table).where(table.c.id.not_in(keep_ids)))
 
 
 def make_db():
     SQLModel.metadata.create_all(db_engine)
+    # create_all skips tables that already exist, so add any newer indexes to them
+    for table in (CheckIn.__table__, Follow.__table__):
+        existing = {ix["name"] for ix in inspect(db_engine).get_indexes(table.name)}
+        for idx in table.indexes:
+            if idx.name in existing:
+                continue
+            if idx.unique:
+                _drop_duplicates(idx)
+            idx.create(db_engine)
+
+    # Trigram index so the people search's ILIKE '%q%' can use an index on Postgres
+    if db_engine.dialect.name == "postgresql":
+        with db_engine.begin() as conn:
+            conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+            conn.execute(
+                text(
+                    "CREATE INDEX IF NOT EXISTS ix_user_username_trgm "
+                    'ON "user" USING gin (username gin_trgm_ops)'
+                )
+            )
 
 
 def seed_if_empty():
     with Session(db_engine) as session_obj:
-        halls_now = session_obj.exec(select(DiningHall)).all()
-        if not halls_now:
+        if not session_obj.exec(select(exists().select_from(DiningHall))).one():
             session_obj.add_all(
                 [
                     DiningHall(hall_name="Hampshire Dining Commons"),
@@ -35,8 +91,7 @@ def seed_if_empty():
                 ]
             )
 
-        users_now = session_obj.exec(select(User)).all()
-        if not users_now:
+        if not session_obj.exec(select(exists().select_from(User))).one():
             session_obj.add_all(
                 [
                     User(username="Mahad", password_hash=hash_password("mahad123")),
@@ -59,4 +114,11 @@ def setup_db():
 
 def get_session():
     with Session(db_engine) as s:
-        yield s
\ No newline at end of file
+        yield s
+
+
+if __name__ == "__main__":
+    # One-shot schema + seed step: python -m app.db init
+    if sys.argv[1:] != ["init"]:
+        sys.exit("usage: python -m app.db init")
+    setup_db()
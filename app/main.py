@@ -1,16 +1,35 @@
-from datetime import datetime
+from datetime import datetime, timedelta
+from functools import lru_cache
 from pathlib import Path
 from typing import Optional, List
 import hashlib
+import hmac
 
 from fastapi import FastAPI, Request, Depends, Form
-from fastapi.responses import HTMLResponse, RedirectResponse
+from fastapi.responses import (
+    HTMLResponse,
+    RedirectResponse,
+    Response,
+    StreamingResponse,
+)
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
+from itsdangerous import BadData, URLSafeTimedSerializer
+from argon2.exceptions import InvalidHashError, VerificationError
+from jinja2 import FileSystemBytecodeCache
+from sqlalchemy import and_, delete, exists, func, or_
+from sqlalchemy.orm import selectinload
 from sqlmodel import Session, select
 
-from .config import is_production, COOKIE_DOMAIN
-from .db import setup_db, get_session
+from .config import is_production, COOKIE_DOMAIN, SECRET_KEY, DEV_SECRET_KEY
+from .db import (
+    setup_db,
+    get_session,
+    hash_password,
+    password_hasher,
+    db_engine,
+    upsert_insert,
+)
 from .models import User, DiningHall, CheckIn, Follow
 
 
@@ -21,12 +40,32 @@ _TEMPLATES_DIR = _PROJECT_ROOT / "templates"
 
 app = FastAPI()
 
-app.mount("/static", StaticFiles(directory=str(_STATIC_DIR)), name="static")
+
+class CachedStaticFiles(StaticFiles):
+    """StaticFiles plus a Cache-Control header. Asset names aren't content-hashed,
+    so keep max-age short; after that browsers revalidate via the built-in ETag."""
+
+    def file_response(self, *args, **kwargs):
+        resp = super().file_response(*args, **kwargs)
+        resp.headers.setdefault("Cache-Control", "public, max-age=3600")
+        return resp
+
+
+app.mount("/static", CachedStaticFiles(directory=str(_STATIC_DIR)), name="static")
 templates = Jinja2Templates(directory=str(_TEMPLATES_DIR))
+# Keep compiled templates across worker restarts (defaults to a per-user temp dir)
+templates.env.bytecode_cache = FileSystemBytecodeCache()
+# Templates only change on deploy, so skip the per-render mtime check in production
+templates.env.auto_reload = not is_production()
 
 
+@lru_cache(maxsize=1)
 def _cookie_kwargs():
-    """Cookie options for production: secure + SameSite so cookies work over HTTPS."""
+    """Cookie options for production: secure + SameSite so cookies work over HTTPS.
+
+    Settings are fixed per process, so the dict is built once and reused; callers
+    only unpack it and must not mutate it.
+    """
     kwargs = {"httponly": True, "samesite": "lax", "path": "/"}
     if is_production():
         kwargs["secure"] = True
@@ -35,33 +74,139 @@ def _cookie_kwargs():
     return kwargs
 
 
+@lru_cache(maxsize=1)
+def _all_halls_cached() -> List[DiningHall]:
+    """Dining halls are seeded at startup and never edited by any route, so load
+    them once per process. Call _all_halls_cached.cache_clear() if that changes."""
+    with Session(db_engine) as s:
+        return s.exec(select(DiningHall)).all()
+
+
 @app.on_event("startup")
 def boot_up():
-    setup_db()
+    # Production runs `python -m app.db init` once before deploy (see railway.toml)
+    # so workers don't all repeat the DDL and seed checks on boot.
+    if not is_production():
+        setup_db()
+
+
+SESSION_COOKIE = "session"
+SESSION_MAX_AGE = 60 * 60 * 24 * 30
+
+# The signed cookie is the only proof of identity, so never sign with the public
+# dev key in production
+if is_production() and SECRET_KEY == DEV_SECRET_KEY:
+    raise RuntimeError("SECRET_KEY must be set to a private value in production")
 
+# Payload is base64-encoded JSON, so any username stays cookie-safe (Latin-1)
+session_serializer = URLSafeTimedSerializer(SECRET_KEY, salt="session")
 
-def read_user_from_cookie(req: Request, db_sess: Session) -> Optional[User]:
-    cookie_val = req.cookies.get("user_id")
-    if not cookie_val:
+
+def make_session_cookie(user: User) -> str:
+    return session_serializer.dumps([user.id, user.username])
+
+
+def read_user_from_cookie(req: Request) -> Optional[User]:
+    """Current user from the signed session cookie.
+
+    The cookie carries id and username, so this returns a detached User without
+    touching the database.
+    """
+    cookie_val = req.cookies.get(SESSION_COOKIE)
+    # Anonymous requests and cookies without the signer's "." separators return
+    # here, before any HMAC check or exception handling
+    if not cookie_val or "." not in cookie_val:
         return None
     try:
-        user_id = int(cookie_val)
-    except (ValueError, TypeError):
+        user_id, username = session_serializer.loads(
+            cookie_val, max_age=SESSION_MAX_AGE
+        )
+    except BadData:
         return None
-    return db_sess.get(User, user_id)
+    # A valid signature means we wrote this [id, username] value ourselves
+    return User(id=user_id, username=username)
 
 
-def make_hash(raw: str) -> str:
-    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+def make_legacy_hash(raw: bytes) -> str:
+    """Unsalted SHA-256, only kept to verify accounts created before Argon2id."""
+    return hashlib.sha256(raw).hexdigest()
+
+
+def is_legacy_hash(stored: str) -> bool:
+    return not stored.startswith("$argon2")
 
 
 def check_password(raw: str, stored: str) -> bool:
-    return make_hash(raw) == stored
+    if is_legacy_hash(stored):
+        return hmac.compare_digest(make_legacy_hash(raw.encode("utf-8")), stored)
+    try:
+        return password_hasher.verify(stored, raw)
+    except (VerificationError, InvalidHashError):
+        return False
+
+
+def needs_rehash(stored: str) -> bool:
+    return is_legacy_hash(stored) or password_hasher.check_needs_rehash(stored)
+
+
+def following_id_set(db_sess: Session, user_id: int) -> frozenset[int]:
+    """Ids the user follows, read as bare ids rather than Follow rows."""
+    return frozenset(
+        db_sess.exec(
+            select(Follow.following_id).where(Follow.follower_id == user_id)
+        ).all()
+    )
+
+
+def feed_filter(user_id: int, now: datetime):
+    """WHERE clause for active check-ins from a user and everyone they follow.
+
+    The followed ids stay in a subquery so the database gets one stable statement
+    instead of an IN list that grows with the follow count.
+    """
+    followed = select(Follow.following_id).where(Follow.follower_id == user_id)
+    return and_(
+        or_(CheckIn.user_id == user_id, CheckIn.user_id.in_(followed)),
+        CheckIn.expires_at > now,
+    )
+
+
+def feed_query(user_id: int, now: datetime):
+    return (
+        select(CheckIn)
+        .options(selectinload(CheckIn.user), selectinload(CheckIn.hall))
+        .where(feed_filter(user_id, now))
+        .order_by(CheckIn.checked_at.desc())
+    )
+
+
+def feed_etag(
+    db_sess: Session,
+    me: User,
+    following_ids: frozenset[int],
+    feed_rows: List[CheckIn],
+    now: datetime,
+) -> str:
+    """Fingerprint of everything feed.html shows.
+
+    Each activity row is keyed by who, where and the "N min ago" value the page
+    prints for it, so the ETag changes exactly when that text changes. The user
+    count and max id stand in for the people list.
+    """
+    activity = tuple(
+        (c.user_id, c.hall_id, int((now - c.checked_at).total_seconds() / 60))
+        for c in feed_rows
+    )
+    user_stats = db_sess.exec(select(func.count(User.id), func.max(User.id))).one()
+
+    key = (me.id, activity, tuple(user_stats), tuple(sorted(following_ids)))
+    digest = hashlib.blake2b(repr(key).encode("utf-8"), digest_size=16).hexdigest()
+    return f'W/"{digest}"'
 
 
 @app.get("/", response_class=HTMLResponse)
-def home(req: Request, db_sess: Session = Depends(get_session)):
-    me = read_user_from_cookie(req, db_sess)
+def home(req: Request):
+    me = read_user_from_cookie(req)
     if me:
         return RedirectResponse("/feed", status_code=303)
     return templates.TemplateResponse(
@@ -71,8 +216,8 @@ def home(req: Request, db_sess: Session = Depends(get_session)):
 
 
 @app.get("/login", response_class=HTMLResponse)
-def login_page(req: Request, db_sess: Session = Depends(get_session)):
-    me = read_user_from_cookie(req, db_sess)
+def login_page(req: Request):
+    me = read_user_from_cookie(req)
     if me:
         return RedirectResponse("/feed", status_code=303)
     return templates.TemplateResponse(
@@ -113,14 +258,20 @@ def login_submit(
             status_code=400,
         )
 
+    # Transparently upgrade legacy SHA-256 (or outdated Argon2) hashes on login
+    if needs_rehash(user_row.password_hash):
+        user_row.password_hash = hash_password(password)
+        db_sess.add(user_row)
+        db_sess.commit()
+
     resp = RedirectResponse("/feed", status_code=303)
-    resp.set_cookie("user_id", str(user_row.id), **_cookie_kwargs())
+    resp.set_cookie(SESSION_COOKIE, make_session_cookie(user_row), **_cookie_kwargs())
     return resp
 
 
 @app.get("/signup", response_class=HTMLResponse)
-def signup_page(req: Request, db_sess: Session = Depends(get_session)):
-    me = read_user_from_cookie(req, db_sess)
+def signup_page(req: Request):
+    me = read_user_from_cookie(req)
     if me:
         return RedirectResponse("/feed", status_code=303)
     return templates.TemplateResponse(
@@ -148,10 +299,10 @@ def signup_submit(
             status_code=400,
         )
 
-    existing = db_sess.exec(
-        select(User).where(User.username == username)
-    ).first()
-    if existing:
+    taken = db_sess.exec(
+        select(exists().where(User.username == username))
+    ).one()
+    if taken:
         return templates.TemplateResponse(
             "signup.html",
             {
@@ -163,50 +314,51 @@ def signup_submit(
 
     new_user = User(
         username=username,
-        password_hash=make_hash(password),
+        password_hash=hash_password(password),
     )
     db_sess.add(new_user)
     db_sess.commit()
     db_sess.refresh(new_user)
 
     resp = RedirectResponse("/feed", status_code=303)
-    resp.set_cookie("user_id", str(new_user.id), **_cookie_kwargs())
+    resp.set_cookie(SESSION_COOKIE, make_session_cookie(new_user), **_cookie_kwargs())
     return resp
 
 
 @app.post("/logout")
 def logout():
     resp = RedirectResponse("/login", status_code=303)
-    resp.delete_cookie("user_id", **_cookie_kwargs())
+    resp.delete_cookie(SESSION_COOKIE, **_cookie_kwargs())
     return resp
 
 
 @app.get("/feed", response_class=HTMLResponse)
 def feed_page(req: Request, db_sess: Session = Depends(get_session)):
-    me = read_user_from_cookie(req, db_sess)
+    me = read_user_from_cookie(req)
     if not me:
         return RedirectResponse("/", status_code=303)
 
     now = datetime.utcnow()
-    follow_links = me.following
-    id_list: List[int] = [me.id] + [row.following_id for row in follow_links]
-
-    q = (
-        select(CheckIn)
-        .where(CheckIn.user_id.in_(id_list))
-        .where(CheckIn.expires_at > now)
-        .order_by(CheckIn.checked_at.desc())
-    )
-    feed_rows = db_sess.exec(q).all()
-
-    halls = db_sess.exec(select(DiningHall)).all()
-
-    all_users = db_sess.exec(select(User)).all()
-    other_users = [u for u in all_users if u.id != me.id]
-    following_ids = {row.following_id for row in follow_links}
-
-    return templates.TemplateResponse(
-        "feed.html",
+    following_ids = following_id_set(db_sess, me.id)
+    feed_rows = db_sess.exec(feed_query(me.id, now)).all()
+
+    # The feed is per-user, so browsers must revalidate. An unchanged page gets a
+    # 304 that skips the people-list query and the render; the key changes
+    # whenever a "N min ago" value does, so this mostly helps rapid reloads.
+    cache_headers = {
+        "ETag": feed_etag(db_sess, me, following_ids, feed_rows, now),
+        "Cache-Control": "private, no-cache",
+    }
+    if req.headers.get("if-none-match") == cache_headers["ETag"]:
+        return Response(status_code=304, headers=cache_headers)
+
+    halls = _all_halls_cached()
+
+    other_users = db_sess.exec(select(User).where(User.id != me.id)).all()
+
+    # The feed is the largest page, so stream it instead of building the whole
+    # HTML string first. Everything it renders is already loaded above.
+    page = templates.get_template("feed.html").stream(
         {
             "request": req,
             "user": me,
@@ -216,13 +368,15 @@ def feed_page(req: Request, db_sess: Session = Depends(get_session)):
             "other_users": other_users,
             "following_ids": following_ids,
             "matches": other_users,
-        },
+        }
     )
+    page.enable_buffering(size=32)
+    return StreamingResponse(page, media_type="text/html", headers=cache_headers)
 
 
 @app.get("/dining/{hall_id}", response_class=HTMLResponse)
 def dining_page(hall_id: int, req: Request, db_sess: Session = Depends(get_session)):
-    me = read_user_from_cookie(req, db_sess)
+    me = read_user_from_cookie(req)
     if not me:
         return RedirectResponse("/", status_code=303)
 
@@ -233,6 +387,7 @@ def dining_page(hall_id: int, req: Request, db_sess: Session = Depends(get_sessi
     now = datetime.utcnow()
     q = (
         select(CheckIn)
+        .options(selectinload(CheckIn.user))
         .where(CheckIn.hall_id == hall_id)
         .where(CheckIn.expires_at > now)
         .order_by(CheckIn.checked_at.desc())
@@ -253,7 +408,7 @@ def dining_page(hall_id: int, req: Request, db_sess: Session = Depends(get_sessi
 
 @app.get("/user/{user_id}", response_class=HTMLResponse)
 def user_profile(user_id: int, req: Request, db_sess: Session = Depends(get_session)):
-    me = read_user_from_cookie(req, db_sess)
+    me = read_user_from_cookie(req)
     if not me:
         return RedirectResponse("/", status_code=303)
 
@@ -261,27 +416,18 @@ def user_profile(user_id: int, req: Request, db_sess: Session = Depends(get_sess
     if not target:
         return RedirectResponse("/feed", status_code=303)
 
-    follower_links = db_sess.exec(
-        select(Follow).where(Follow.following_id == target.id)
+    follower_users: List[User] = db_sess.exec(
+        select(User)
+        .join(Follow, Follow.follower_id == User.id)
+        .where(Follow.following_id == target.id)
     ).all()
-    following_links = db_sess.exec(
-        select(Follow).where(Follow.follower_id == target.id)
+    following_users: List[User] = db_sess.exec(
+        select(User)
+        .join(Follow, Follow.following_id == User.id)
+        .where(Follow.follower_id == target.id)
     ).all()
 
-    follower_users: List[User] = []
-    for link in follower_links:
-        u = db_sess.get(User, link.follower_id)
-        if u:
-            follower_users.append(u)
-
-    following_users: List[User] = []
-    for link in following_links:
-        u = db_sess.get(User, link.following_id)
-        if u:
-            following_users.append(u)
-
-    follow_links_me = me.following
-    following_ids_me = {row.following_id for row in follow_links_me}
+    following_ids_me = following_id_set(db_sess, me.id)
 
     latest_checkin = db_sess.exec(
         select(CheckIn)
@@ -303,13 +449,16 @@ def user_profile(user_id: int, req: Request, db_sess: Session = Depends(get_sess
     )
 
 
+PEOPLE_SEARCH_LIMIT = 20
+
+
 @app.get("/people/search", response_class=HTMLResponse)
 def people_search(
     req: Request,
     q: str = "",
     db_sess: Session = Depends(get_session),
 ):
-    me = read_user_from_cookie(req, db_sess)
+    me = read_user_from_cookie(req)
     if not me:
         return RedirectResponse("/", status_code=303)
 
@@ -317,14 +466,17 @@ def people_search(
     matches: List[User] = []
 
     if q_clean:
+        # Escape LIKE wildcards so the query is matched literally
+        pattern = q_clean.replace("/", "//").replace("%", "/%").replace("_", "/_")
         matches = db_sess.exec(
             select(User)
             .where(User.id != me.id)
-            .where(User.username.contains(q_clean))
+            .where(User.username.ilike(f"%{pattern}%", escape="/"))
+            .order_by(User.username)
+            .limit(PEOPLE_SEARCH_LIMIT)
         ).all()
 
-    follow_links = me.following
-    following_ids = {row.following_id for row in follow_links}
+    following_ids = following_id_set(db_sess, me.id)
 
     return templates.TemplateResponse(
         "fragments/people_results.html",
@@ -342,7 +494,7 @@ def checkin_post(
     hall_id: int = Form(...),
     db_sess: Session = Depends(get_session),
 ):
-    me = read_user_from_cookie(req, db_sess)
+    me = read_user_from_cookie(req)
     if not me:
         return RedirectResponse("/", status_code=303)
 
@@ -350,28 +502,28 @@ def checkin_post(
     if not hall_row:
         return RedirectResponse("/feed", status_code=303)
 
-    old_rows = db_sess.exec(
-        select(CheckIn).where(CheckIn.user_id == me.id)
-    ).all()
-    for row in old_rows:
-        db_sess.delete(row)
-
-    new_row = CheckIn(user_id=me.id, hall_id=hall_id)
-    db_sess.add(new_row)
+    # Replace the user's check-in (active or expired) in one statement
+    checked_at = datetime.utcnow()
+    stmt = upsert_insert(CheckIn).values(
+        user_id=me.id,
+        hall_id=hall_id,
+        checked_at=checked_at,
+        expires_at=checked_at + timedelta(hours=1),
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[CheckIn.user_id],
+        set_={
+            "hall_id": stmt.excluded.hall_id,
+            "checked_at": stmt.excluded.checked_at,
+            "expires_at": stmt.excluded.expires_at,
+        },
+    )
+    db_sess.exec(stmt)
     db_sess.commit()
 
     if req.headers.get("HX-Request") == "true":
         now = datetime.utcnow()
-        follow_links = me.following
-        id_list: List[int] = [me.id] + [link.following_id for link in follow_links]
-
-        q = (
-            select(CheckIn)
-            .where(CheckIn.user_id.in_(id_list))
-            .where(CheckIn.expires_at > now)
-            .order_by(CheckIn.checked_at.desc())
-        )
-        feed_rows = db_sess.exec(q).all()
+        feed_rows = db_sess.exec(feed_query(me.id, now)).all()
 
         return templates.TemplateResponse(
             "fragments/activity.html",
@@ -391,29 +543,16 @@ def clear_checkin(
     req: Request,
     db_sess: Session = Depends(get_session),
 ):
-    me = read_user_from_cookie(req, db_sess)
+    me = read_user_from_cookie(req)
     if not me:
         return RedirectResponse("/", status_code=303)
 
-    rows = db_sess.exec(
-        select(CheckIn).where(CheckIn.user_id == me.id)
-    ).all()
-    for row in rows:
-        db_sess.delete(row)
+    db_sess.exec(delete(CheckIn).where(CheckIn.user_id == me.id))
     db_sess.commit()
 
     if req.headers.get("HX-Request") == "true":
         now = datetime.utcnow()
-        follow_links = me.following
-        id_list: List[int] = [me.id] + [link.following_id for link in follow_links]
-
-        q = (
-            select(CheckIn)
-            .where(CheckIn.user_id.in_(id_list))
-            .where(CheckIn.expires_at > now)
-            .order_by(CheckIn.checked_at.desc())
-        )
-        feed_rows = db_sess.exec(q).all()
+        feed_rows = db_sess.exec(feed_query(me.id, now)).all()
 
         return templates.TemplateResponse(
             "fragments/activity.html",
@@ -434,24 +573,22 @@ def follow_user(
     user_id: int = Form(...),
     db_sess: Session = Depends(get_session),
 ):
-    me = read_user_from_cookie(req, db_sess)
+    me = read_user_from_cookie(req)
     if not me:
         return RedirectResponse("/", status_code=303)
 
     if user_id == me.id:
         return RedirectResponse("/feed", status_code=303)
 
-    existing = db_sess.exec(
-        select(Follow).where(
-            Follow.follower_id == me.id,
-            Follow.following_id == user_id,
+    # The unique (follower_id, following_id) index turns a repeat follow into a no-op
+    db_sess.exec(
+        upsert_insert(Follow)
+        .values(follower_id=me.id, following_id=user_id, made_at=datetime.utcnow())
+        .on_conflict_do_nothing(
+            index_elements=[Follow.follower_id, Follow.following_id]
         )
-    ).first()
-
-    if not existing:
-        row = Follow(follower_id=me.id, following_id=user_id)
-        db_sess.add(row)
-        db_sess.commit()
+    )
+    db_sess.commit()
 
     return RedirectResponse("/feed", status_code=303)
 
@@ -462,19 +599,15 @@ def unfollow_user(
     user_id: int = Form(...),
     db_sess: Session = Depends(get_session),
 ):
-    me = read_user_from_cookie(req, db_sess)
+    me = read_user_from_cookie(req)
     if not me:
         return RedirectResponse("/", status_code=303)
 
-    rows = db_sess.exec(
-        select(Follow).where(
+    db_sess.exec(
+        delete(Follow).where(
             Follow.follower_id == me.id,
             Follow.following_id == user_id,
         )
-    ).all()
-
-    for row in rows:
-        db_sess.delete(row)
-
+    )
     db_sess.commit()
     return RedirectResponse("/feed", status_code=303)
\ No newline at end of file
@@ -1,6 +1,7 @@
 from datetime import datetime, timedelta
 from typing import Optional, List
 
+from sqlalchemy import Index
 from sqlmodel import SQLModel, Field, Relationship
 
 
@@ -29,6 +30,12 @@ class DiningHall(SQLModel, table=True):
 
 
 class CheckIn(SQLModel, table=True):
+    __table_args__ = (
+        # One check-in row per user; /checkin upserts against this
+        Index("uq_checkin_user", "user_id", unique=True),
+        Index("ix_checkin_hall_expires", "hall_id", "expires_at"),
+    )
+
     id: Optional[int] = Field(default=None, primary_key=True)
 
     user_id: int = Field(foreign_key="user.id")
@@ -44,6 +51,11 @@ class CheckIn(SQLModel, table=True):
 
 
 class Follow(SQLModel, table=True):
+    __table_args__ = (
+        Index("ix_follow_follower_following", "follower_id", "following_id", unique=True),
+        Index("ix_follow_following", "following_id"),
+    )
+
     id: Optional[int] = Field(default=None, primary_key=True)
 
     follower_id: int = Field(foreign_key="user.id")